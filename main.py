@@ -1,10 +1,24 @@
+import os
+import asyncio
+import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-import statsbombpy as sb
+from fastapi.responses import ORJSONResponse
+from statsbombpy import sb
+from statsbombpy.helpers import flatten_event
 import pandas as pd
-from typing import List, Dict, Any
+import orjson
+import redis
+from dotenv import load_dotenv
+from functools import lru_cache
+from typing import List, Dict, Any, Callable
 
-app = FastAPI(title="StatsBomb Football API", version="1.0.0")
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="StatsBomb Football API", version="1.0.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,243 +42,290 @@ COMPETITION_MAPPINGS = {
     # Note: DED (Eredivisie), BSA (Campeonato Brasileiro Série A), PPL (Primeira Liga) not available in StatsBomb open data
 }
 
+# Redis cache in front of StatsBomb open data; disabled when REDIS_URL is unset
+REDIS_URL = os.getenv('REDIS_URL')
+CACHE_TTL = 24 * 60 * 60  # Finished matches rarely change, so a day is safe
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Event frames kept in process memory, shared by the events and stats endpoints
+EVENTS_CACHE_SIZE = 16
+
+# Event fields exposed by /api/statsbomb/events/{match_id}; these are null when absent
+EVENT_BASE_COLS = [
+    "id",
+    "type",
+    "team",
+    "player",
+    "minute",
+    "second",
+    "location",  # [x, y] coordinates
+]
+
+# Nested event attributes exposed alongside EVENT_BASE_COLS; these default to {} when absent
+EVENT_ATTR_COLS = [
+    "shot",
+    "pass",
+    "carry",
+    "duel",
+    "tactics",
+    "goalkeeper",
+    "foul_committed",
+    "foul_won",
+    "ball_receipt",
+    "ball_recovery",
+    "interception",
+    "clearance",
+    "dribble",
+    "block",
+    "miscontrol",
+    "dispossessed",
+]
+
+EVENT_COLS = EVENT_BASE_COLS + EVENT_ATTR_COLS
+
+# Event fields that StatsBomb sends as {"id", "name"} references; only the name is exposed
+EVENT_NAME_COLS = {"type", "team", "player"}
+
+# Shot outcomes counted as shots on target
+ON_TARGET_OUTCOMES = ["Goal", "Saved", "Post"]
+
+# Event types counted as-is in team stats: StatsBomb type -> stat name
+TEAM_TYPE_COUNTS = {
+    "Goal": "goals",
+    "Shot": "shots",
+    "Pass": "passes_attempted",
+    "Tackle": "tackles",
+    "Interception": "interceptions",
+    "Corner": "corners",
+    "Foul Committed": "fouls",
+}
+
+# Column order of /api/statsbomb/team-stats/{match_id} entries
+TEAM_STAT_COLS = [
+    "goals",
+    "shots",
+    "shots_on_target",
+    "passes_completed",
+    "passes_attempted",
+    "tackles",
+    "interceptions",
+    "duels_won",
+    "duels_lost",
+    "corners",
+    "fouls",
+    "yellow_cards",
+    "red_cards",
+    "xg",
+]
+
+# Low-cardinality event columns aggregated on integer category codes
+CATEGORICAL_EVENT_COLS = ["type", "team", "player"]
+
+def _categorize(events: pd.DataFrame) -> pd.DataFrame:
+    """Convert the low-cardinality event columns to categoricals"""
+    return events.astype({col: "category" for col in CATEGORICAL_EVENT_COLS if col in events})
+
+def _project_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Pick the EVENT_COLS fields from a raw StatsBomb event"""
+    projected = {col: event.get(col) for col in EVENT_BASE_COLS}
+    # Nested attributes default to {} so clients can index into them without a null check
+    projected.update((col, event.get(col, {})) for col in EVENT_ATTR_COLS)
+    for col in EVENT_NAME_COLS:
+        if isinstance(projected[col], dict):
+            projected[col] = projected[col].get("name")
+    return projected
+
+def _column(events: pd.DataFrame, name: str) -> pd.Series:
+    """Get a flattened event attribute, or an empty column if no event in the match has it"""
+    if name in events:
+        return events[name]
+    return pd.Series(None, index=events.index, dtype=object)
+
+def cached(key: str, fetch: Callable[[], Any], ttl: int = CACHE_TTL) -> Any:
+    """Return the JSON value cached under key, calling fetch and caching its result on a miss"""
+    if redis_client is None:
+        return fetch()
+
+    try:
+        value = redis_client.get(key)
+        if value is not None:
+            return orjson.loads(value)
+    except redis.RedisError as e:
+        logger.warning(f"Redis read failed for {key}: {e}")
+
+    data = fetch()
+    try:
+        redis_client.setex(key, ttl, orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+    except redis.RedisError as e:
+        logger.warning(f"Redis write failed for {key}: {e}")
+    return data
+
+def fetch_competitions() -> List[Dict[str, Any]]:
+    """Get StatsBomb competitions as records"""
+    return cached("competitions", lambda: sb.competitions().to_dict('records'))
+
+def fetch_matches(competition_id: int, season_id: int) -> List[Dict[str, Any]]:
+    """Get StatsBomb matches for a competition season as records"""
+    return cached(
+        f"matches:{competition_id}:{season_id}",
+        lambda: sb.matches(competition_id=competition_id, season_id=season_id).to_dict('records'),
+    )
+
+@lru_cache(maxsize=EVENTS_CACHE_SIZE)
+def fetch_raw_events(match_id: int) -> List[Dict[str, Any]]:
+    """Get the raw StatsBomb events for a match in match order, memoized per process; callers must not mutate them
+
+    This is the single upstream fetch shared by the events, player-stats and team-stats endpoints.
+    """
+    return cached(f"raw_events:{match_id}", lambda: list(sb.events(match_id=match_id, fmt="dict").values()))
+
+@lru_cache(maxsize=EVENTS_CACHE_SIZE)
+def fetch_events(match_id: int) -> pd.DataFrame:
+    """Get StatsBomb events for a match as a DataFrame, memoized per process; callers must not mutate the frame
+
+    Nested attributes are flattened into top-level columns (shot_outcome, pass_goal_assist,
+    shot_statsbomb_xg, ...) so the stats endpoints can compare them column-wise.
+    """
+    # flatten_event rewrites the event it is given, so flatten shallow copies of the shared raw events
+    flattened = [flatten_event(dict(event), flatten_attrs=True) for event in fetch_raw_events(match_id)]
+    return _categorize(pd.DataFrame(flattened))
+
+def fetch_event_list(match_id: int) -> List[Dict[str, Any]]:
+    """Get the exposed fields of every StatsBomb event for a match, straight from the raw JSON"""
+    return [_project_event(event) for event in fetch_raw_events(match_id)]
+
+def fetch_lineups(match_id: int) -> Dict[str, Dict[str, Any]]:
+    """Get StatsBomb lineups for a match, keyed by team name"""
+    return cached(
+        f"lineups:{match_id}",
+        lambda: {team: lineup.to_dict() for team, lineup in sb.lineups(match_id=match_id).items()},
+    )
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "StatsBomb Football API", "status": "running"}
 
 @app.get("/api/statsbomb/competitions")
-def get_competitions():
+async def get_competitions():
     """Get available competitions"""
     try:
-        competitions = sb.competitions()
-        return {"success": True, "data": competitions.to_dict('records')}
+        competitions = await asyncio.to_thread(fetch_competitions)
+        return ORJSONResponse({"success": True, "data": competitions})
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 @app.get("/api/statsbomb/matches/{competition_code}")
-def get_matches(competition_code: str, season_id: int = 2023):
+async def get_matches(competition_code: str, season_id: int = 2023):
     """Get matches for a competition"""
     try:
         comp_id = COMPETITION_MAPPINGS.get(competition_code.upper())
         if not comp_id:
             return {"success": False, "error": f"Competition {competition_code} not found"}
 
-        matches = sb.matches(competition_id=comp_id, season_id=season_id)
-        return {"success": True, "data": matches.to_dict('records')}
+        matches = await asyncio.to_thread(fetch_matches, comp_id, season_id)
+        return ORJSONResponse({"success": True, "data": matches})
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 @app.get("/api/statsbomb/events/{match_id}")
-def get_match_events(match_id: int):
+async def get_match_events(match_id: int):
     """Get detailed events for a match"""
     try:
-        events = sb.events(match_id=match_id)
-
-        # Process events to include advanced stats
-        processed_events = []
-        for _, event in events.iterrows():
-            processed_event = {
-                "id": event.get("id"),
-                "type": event.get("type"),
-                "team": event.get("team"),
-                "player": event.get("player"),
-                "minute": event.get("minute"),
-                "second": event.get("second"),
-                "location": event.get("location"),  # [x, y] coordinates
-                "shot": event.get("shot", {}),
-                "pass": event.get("pass", {}),
-                "carry": event.get("carry", {}),
-                "duel": event.get("duel", {}),
-                "tactics": event.get("tactics", {}),
-                "goalkeeper": event.get("goalkeeper", {}),
-                "foul_committed": event.get("foul_committed", {}),
-                "foul_won": event.get("foul_won", {}),
-                "ball_receipt": event.get("ball_receipt", {}),
-                "ball_recovery": event.get("ball_recovery", {}),
-                "interception": event.get("interception", {}),
-                "clearance": event.get("clearance", {}),
-                "dribble": event.get("dribble", {}),
-                "block": event.get("block", {}),
-                "miscontrol": event.get("miscontrol", {}),
-                "dispossessed": event.get("dispossessed", {}),
-            }
-            processed_events.append(processed_event)
-
-        return {"success": True, "data": processed_events}
+        events = await asyncio.to_thread(fetch_event_list, match_id)
+        return ORJSONResponse({"success": True, "data": events})
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 @app.get("/api/statsbomb/lineups/{match_id}")
-def get_match_lineups(match_id: int):
+async def get_match_lineups(match_id: int):
     """Get match lineups"""
     try:
-        lineups = sb.lineups(match_id=match_id)
-        return {"success": True, "data": lineups}
+        lineups = await asyncio.to_thread(fetch_lineups, match_id)
+        return ORJSONResponse({"success": True, "data": lineups})
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 @app.get("/api/statsbomb/player-stats/{match_id}")
-def get_player_stats(match_id: int):
+async def get_player_stats(match_id: int):
     """Get detailed player statistics for a match"""
     try:
-        events = sb.events(match_id=match_id)
-
-        # Aggregate player stats
-        player_stats = {}
-
-        for _, event in events.iterrows():
-            player = event.get("player")
-            if not player:
-                continue
-
-            if player not in player_stats:
-                player_stats[player] = {
-                    "name": player,
-                    "team": event.get("team"),
-                    "minutes_played": 0,
-                    "goals": 0,
-                    "assists": 0,
-                    "shots": 0,
-                    "shots_on_target": 0,
-                    "passes_completed": 0,
-                    "passes_attempted": 0,
-                    "tackles": 0,
-                    "interceptions": 0,
-                    "duels_won": 0,
-                    "duels_lost": 0,
-                    "yellow_cards": 0,
-                    "red_cards": 0,
-                    "xg": 0.0,
-                    "xa": 0.0,
-                }
-
-            # Count different event types
-            event_type = event.get("type")
-
-            if event_type == "Shot":
-                player_stats[player]["shots"] += 1
-                shot = event.get("shot", {})
-                if shot.get("outcome", {}).get("name") in ["Goal", "Saved", "Post"]:
-                    player_stats[player]["shots_on_target"] += 1
-                if "statsbomb_xg" in shot:
-                    player_stats[player]["xg"] += shot["statsbomb_xg"]
-
-            elif event_type == "Pass":
-                pass_event = event.get("pass", {})
-                if pass_event.get("outcome", {}).get("name") != "Incomplete":
-                    player_stats[player]["passes_completed"] += 1
-                player_stats[player]["passes_attempted"] += 1
-
-                # Check for assists
-                if pass_event.get("goal_assist") == True:
-                    player_stats[player]["assists"] += 1
-                    if "statsbomb_xg" in pass_event:
-                        player_stats[player]["xa"] += pass_event["statsbomb_xg"]
-
-            elif event_type == "Goal":
-                player_stats[player]["goals"] += 1
-
-            elif event_type == "Tackle":
-                player_stats[player]["tackles"] += 1
-
-            elif event_type == "Interception":
-                player_stats[player]["interceptions"] += 1
-
-            elif event_type == "Duel":
-                duel = event.get("duel", {})
-                if duel.get("outcome", {}).get("name") == "Won":
-                    player_stats[player]["duels_won"] += 1
-                else:
-                    player_stats[player]["duels_lost"] += 1
-
-            elif event_type == "Foul Committed":
-                foul = event.get("foul_committed", {})
-                card = foul.get("card", {})
-                if card.get("name") == "Yellow Card":
-                    player_stats[player]["yellow_cards"] += 1
-                elif card.get("name") == "Red Card":
-                    player_stats[player]["red_cards"] += 1
-
-        return {"success": True, "data": list(player_stats.values())}
+        events = await asyncio.to_thread(fetch_events, match_id)
+        events = events[events["player"].notna()]
+
+        # One boolean column per counted stat, summed per player in a single groupby
+        is_type = events["type"].eq
+        shots = is_type("Shot")
+        passes = is_type("Pass")
+        duels = is_type("Duel")
+        fouls = is_type("Foul Committed")
+        assists = passes & _column(events, "pass_goal_assist").eq(True)
+        duel_won = _column(events, "duel_outcome").eq("Won")
+        card = _column(events, "foul_committed_card")
+
+        counts = pd.DataFrame({
+            "goals": is_type("Goal"),
+            "assists": assists,
+            "shots": shots,
+            "shots_on_target": shots & _column(events, "shot_outcome").isin(ON_TARGET_OUTCOMES),
+            "passes_completed": passes & _column(events, "pass_outcome").ne("Incomplete"),
+            "passes_attempted": passes,
+            "tackles": is_type("Tackle"),
+            "interceptions": is_type("Interception"),
+            "duels_won": duels & duel_won,
+            "duels_lost": duels & ~duel_won,
+            "yellow_cards": fouls & card.eq("Yellow Card"),
+            "red_cards": fouls & card.eq("Red Card"),
+        }).astype(int)
+        counts["xg"] = _column(events, "shot_statsbomb_xg").where(shots).astype(float).fillna(0.0)
+        counts["xa"] = _column(events, "pass_statsbomb_xg").where(assists).astype(float).fillna(0.0)
+
+        by_player = events.groupby("player", sort=False, observed=True)
+        player_stats = counts.groupby(events["player"], sort=False, observed=True).sum()
+        player_stats.insert(0, "team", by_player["team"].first())
+        player_stats.insert(1, "minutes_played", 0)
+        player_stats = player_stats.rename_axis("name").reset_index()
+
+        return ORJSONResponse({"success": True, "data": player_stats.to_dict('records')})
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 @app.get("/api/statsbomb/team-stats/{match_id}")
-def get_team_stats(match_id: int):
+async def get_team_stats(match_id: int):
     """Get team statistics for a match"""
     try:
-        events = sb.events(match_id=match_id)
-
-        team_stats = {}
-
-        for _, event in events.iterrows():
-            team = event.get("team")
-            if not team:
-                continue
-
-            if team not in team_stats:
-                team_stats[team] = {
-                    "team": team,
-                    "goals": 0,
-                    "shots": 0,
-                    "shots_on_target": 0,
-                    "passes_completed": 0,
-                    "passes_attempted": 0,
-                    "tackles": 0,
-                    "interceptions": 0,
-                    "duels_won": 0,
-                    "duels_lost": 0,
-                    "corners": 0,
-                    "fouls": 0,
-                    "yellow_cards": 0,
-                    "red_cards": 0,
-                    "xg": 0.0,
-                }
-
-            event_type = event.get("type")
-
-            if event_type == "Shot":
-                team_stats[team]["shots"] += 1
-                shot = event.get("shot", {})
-                if shot.get("outcome", {}).get("name") in ["Goal", "Saved", "Post"]:
-                    team_stats[team]["shots_on_target"] += 1
-                if "statsbomb_xg" in shot:
-                    team_stats[team]["xg"] += shot["statsbomb_xg"]
-
-            elif event_type == "Pass":
-                pass_event = event.get("pass", {})
-                if pass_event.get("outcome", {}).get("name") != "Incomplete":
-                    team_stats[team]["passes_completed"] += 1
-                team_stats[team]["passes_attempted"] += 1
-
-            elif event_type == "Goal":
-                team_stats[team]["goals"] += 1
-
-            elif event_type == "Tackle":
-                team_stats[team]["tackles"] += 1
-
-            elif event_type == "Interception":
-                team_stats[team]["interceptions"] += 1
-
-            elif event_type == "Duel":
-                duel = event.get("duel", {})
-                if duel.get("outcome", {}).get("name") == "Won":
-                    team_stats[team]["duels_won"] += 1
-                else:
-                    team_stats[team]["duels_lost"] += 1
-
-            elif event_type == "Corner":
-                team_stats[team]["corners"] += 1
-
-            elif event_type == "Foul Committed":
-                team_stats[team]["fouls"] += 1
-                foul = event.get("foul_committed", {})
-                card = foul.get("card", {})
-                if card.get("name") == "Yellow Card":
-                    team_stats[team]["yellow_cards"] += 1
-                elif card.get("name") == "Red Card":
-                    team_stats[team]["red_cards"] += 1
-
-        return {"success": True, "data": list(team_stats.values())}
+        events = await asyncio.to_thread(fetch_events, match_id)
+        events = events[events["team"].notna()]
+        teams = events["team"].unique()
+
+        # Plain event counts come straight out of a team x type crosstab
+        type_counts = (
+            pd.crosstab(events["team"], events["type"])
+            .reindex(index=teams, columns=list(TEAM_TYPE_COUNTS), fill_value=0)
+            .rename(columns=TEAM_TYPE_COUNTS)
+        )
+
+        # Outcome-dependent counts need a mask over the flattened attributes
+        shots = events["type"].eq("Shot")
+        passes = events["type"].eq("Pass")
+        duels = events["type"].eq("Duel")
+        fouls = events["type"].eq("Foul Committed")
+        duel_won = _column(events, "duel_outcome").eq("Won")
+        card = _column(events, "foul_committed_card")
+
+        outcome_counts = pd.DataFrame({
+            "shots_on_target": shots & _column(events, "shot_outcome").isin(ON_TARGET_OUTCOMES),
+            "passes_completed": passes & _column(events, "pass_outcome").ne("Incomplete"),
+            "duels_won": duels & duel_won,
+            "duels_lost": duels & ~duel_won,
+            "yellow_cards": fouls & card.eq("Yellow Card"),
+            "red_cards": fouls & card.eq("Red Card"),
+        }).astype(int)
+        outcome_counts["xg"] = _column(events, "shot_statsbomb_xg").where(shots).astype(float).fillna(0.0)
+        outcome_counts = outcome_counts.groupby(events["team"], observed=True).sum()
+
+        team_stats = type_counts.join(outcome_counts)[TEAM_STAT_COLS]
+        team_stats = team_stats.rename_axis("team").reset_index()
+
+        return ORJSONResponse({"success": True, "data": team_stats.to_dict('records')})
     except Exception as e:
         return {"success": False, "error": str(e)}
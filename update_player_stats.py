@@ -1,6 +1,7 @@
 
 import os
 import logging
+import pandas as pd
 from typing import Dict, List
 from dotenv import load_dotenv
 from supabase import create_client, Client
@@ -28,65 +29,83 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Rows requested per page; PostgREST caps a single response at 1000 rows by default
+PAGE_SIZE = 1000
+
+# Maximum rows sent to Supabase in a single upsert request
+UPSERT_BATCH_SIZE = 1000
+
 def get_all_players() -> List[Dict]:
-    """Get all players from the database"""
-    response = supabase.table('players').select('*').execute()
-    return response.data
-
-def get_player_matches(player_id: int) -> List[Dict]:
-    """Get all matches where a player participated"""
-    # Get match_player_stats for this player
-    response = supabase.table('match_player_stats').select('match_id, rating').eq('player_id', player_id).execute()
-    return response.data
-
-def calculate_player_stats(player_id: int) -> Dict:
-    """Calculate best rating, worst rating, yellow cards, red cards for a player"""
-    matches = get_player_matches(player_id)
-
-    if not matches:
-        return {
-            'best_rating': 0.0,
-            'worst_rating': 0.0,
-            'yellow_cards': 0,
-            'red_cards': 0
-        }
-
-    ratings = [match['rating'] for match in matches if match['rating'] is not None and match['rating'] > 0]
-
-    # Calculate best and worst ratings
-    best_rating = max(ratings) if ratings else 0.0
-    worst_rating = min(ratings) if ratings else 0.0
+    """Get all players from the database, paging through the PostgREST row limit"""
+    players = []
+    start = 0
+    while True:
+        response = (
+            supabase.table('players')
+            .select('*')
+            .order('id')
+            .range(start, start + PAGE_SIZE - 1)
+            .execute()
+        )
+        players.extend(response.data)
+        if len(response.data) < PAGE_SIZE:
+            return players
+        start += PAGE_SIZE
+
+def get_all_ratings() -> List[Dict]:
+    """Get every positive match rating, paging through the PostgREST row limit"""
+    ratings = []
+    start = 0
+    while True:
+        response = (
+            supabase.table('match_player_stats')
+            .select('player_id, rating')
+            .gt('rating', 0)
+            .order('player_id')
+            .order('rating')
+            .range(start, start + PAGE_SIZE - 1)
+            .execute()
+        )
+        ratings.extend(response.data)
+        if len(response.data) < PAGE_SIZE:
+            return ratings
+        start += PAGE_SIZE
+
+def calculate_all_player_stats(player_ids: List[int]) -> Dict[int, Dict]:
+    """Calculate best rating, worst rating, yellow cards, red cards for every player at once"""
+    ratings = pd.DataFrame(get_all_ratings(), columns=['player_id', 'rating'])
+
+    # Best and worst ratings per player; players without a rated match get 0.0
+    rating_range = (
+        ratings.groupby('player_id')['rating']
+        .agg(best_rating='max', worst_rating='min')
+        .reindex(player_ids, fill_value=0.0)
+    )
 
     # For cards, we need to aggregate from match events
     # This is a simplified version - in a real implementation,
     # you'd want to store card events in the database
-    yellow_cards = 0
-    red_cards = 0
+    rating_range['yellow_cards'] = 0
+    rating_range['red_cards'] = 0
 
     # For now, we'll set cards to 0 and note that this needs to be implemented
     # based on actual match events data
-    logger.warning(f"Card counting not implemented yet for player {player_id}")
-
-    return {
-        'best_rating': best_rating,
-        'worst_rating': worst_rating,
-        'yellow_cards': yellow_cards,
-        'red_cards': red_cards
-    }
-
-def update_player_stats(player_id: int, stats: Dict):
-    """Update player stats in the database"""
-    try:
-        supabase.table('players').update({
-            'best_rating': stats['best_rating'],
-            'worst_rating': stats['worst_rating'],
-            'yellow_cards': stats['yellow_cards'],
-            'red_cards': stats['red_cards']
-        }).eq('id', player_id).execute()
-
-        logger.info(f"Updated stats for player {player_id}: {stats}")
-    except Exception as e:
-        logger.error(f"Failed to update player {player_id}: {e}")
+    logger.warning("Card counting not implemented yet, cards are set to 0 for all players")
+
+    return rating_range.to_dict('index')
+
+def update_all_player_stats(players: List[Dict], all_stats: Dict[int, Dict]):
+    """Write every player's stats back to the database with batched upserts"""
+    # Send the full player rows so inserts triggered by the upsert never miss required columns
+    rows = [{**player, **all_stats[player['id']]} for player in players]
+
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        batch = rows[start:start + UPSERT_BATCH_SIZE]
+        try:
+            supabase.table('players').upsert(batch, on_conflict='id').execute()
+            logger.info(f"Updated stats for {len(batch)} players")
+        except Exception as e:
+            logger.error(f"Failed to update players {batch[0]['id']}..{batch[-1]['id']}: {e}")
 
 def main():
     """Main function to update all players' stats"""
@@ -95,12 +114,8 @@ def main():
     players = get_all_players()
     logger.info(f"Found {len(players)} players to update")
 
-    for player in players:
-        player_id = player['id']
-        logger.info(f"Processing player {player_id} ({player.get('name', 'Unknown')})")
-
-        stats = calculate_player_stats(player_id)
-        update_player_stats(player_id, stats)
+    all_stats = calculate_all_player_stats([player['id'] for player in players])
+    update_all_player_stats(players, all_stats)
 
     logger.info("Player stats update completed!")
 
@@ -1,9 +1,13 @@
 import os
 import logging
 import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
-import statsbombpy as sb
+from typing import List, Dict, Any, Optional, Tuple
+from statsbombpy import api_client, sb
+from statsbombpy.config import DEFAULT_CREDS, OPEN_DATA_PATHS
+from statsbombpy.helpers import flatten_event
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import ast
@@ -22,6 +26,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Matches fetched and written concurrently; the work is dominated by HTTP latency
+MAX_WORKERS = 16
+
+# Maximum rows sent to Supabase in a single upsert request
+UPSERT_BATCH_SIZE = 1000
+
+# Seconds to wait on the open-data server before giving up on a match's events
+REQUEST_TIMEOUT = 30
+
+# Map competition IDs to countries
+COUNTRY_BY_COMP = pd.Series({
+    43: 'International',  # WC
+    16: 'Europe',  # CL
+    9: 'Germany',  # BL1
+    11: 'Spain',  # PD
+    7: 'France',  # FL1
+    2: 'England',  # PL
+    12: 'Italy',  # SA
+    68: 'Europe',  # EC
+    35: 'Europe'  # ELC
+})
+
+# Event types that produce a match_player_stats row
+STAT_EVENT_TYPES = ['Pass', 'Shot', 'Dribble', 'Carry']
+
+# Rows read from Supabase per page; PostgREST caps a single response at 1000 rows by default
+PAGE_SIZE = 1000
+
+# ETag stored for a match whose rows were not all written: it selects the match on the next run
+# and, being empty, sends no If-None-Match so the events are refetched in full
+RETRY_ETAG = ''
+
+# Rows produced for one match: (teams, match, players, match player stats, events ETag)
+MatchRows = Tuple[List[Dict[str, Any]], Dict[str, Any], List[Dict[str, Any]], List[Dict[str, Any]], Optional[str]]
+
 class StatsBombUpdater:
     def __init__(self):
         self.supabase_url = os.getenv('SUPABASE_URL')
@@ -57,12 +96,12 @@ class StatsBombUpdater:
             logger.error(f"Error getting competitions: {e}")
             return pd.DataFrame()
 
-    def get_recent_seasons(self, comp_id: int, num_seasons: int = 2) -> List[int]:
+    def get_recent_seasons(self, competitions: pd.DataFrame, comp_id: int, num_seasons: int = 2) -> List[int]:
         """Get the most recent season IDs for a competition"""
         try:
-            matches = sb.matches(competition_id=comp_id)
-            seasons = matches['season_id'].unique()
-            recent_seasons = sorted(seasons, reverse=True)[:num_seasons]
+            # Season names ("2015/2016", "2022") sort chronologically; season IDs do not
+            seasons = competitions[competitions['competition_id'] == comp_id].sort_values('season_name', ascending=False)
+            recent_seasons = seasons['season_id'].head(num_seasons).tolist()
             logger.info(f"Recent seasons for comp {comp_id}: {recent_seasons}")
             return recent_seasons
         except Exception as e:
@@ -72,22 +111,70 @@ class StatsBombUpdater:
     def get_all_matches(self, comp_id: int, season_id: int) -> pd.DataFrame:
         """Get all matches in a season"""
         try:
-            matches = sb.matches(competition_id=comp_id, season_id=season_id)
+            # The dict format keeps the team and competition IDs that the DataFrame format drops
+            raw_matches = sb.matches(competition_id=comp_id, season_id=season_id, fmt="dict")
+            matches = pd.DataFrame([
+                {
+                    'match_id': match['match_id'],
+                    'match_date': match['match_date'],
+                    'competition_id': match['competition']['competition_id'],
+                    'season_id': match['season']['season_id'],
+                    'match_week': match.get('match_week'),
+                    'home_team_id': match['home_team']['home_team_id'],
+                    'home_team': match['home_team']['home_team_name'],
+                    'away_team_id': match['away_team']['away_team_id'],
+                    'away_team': match['away_team']['away_team_name'],
+                    'home_score': match.get('home_score'),
+                    'away_score': match.get('away_score'),
+                    'match_status': match.get('match_status'),
+                }
+                for match in raw_matches.values()
+            ])
             logger.info(f"Found {len(matches)} matches in season {season_id} for competition {comp_id}")
             return matches
         except Exception as e:
             logger.error(f"Error getting matches for competition {comp_id}: {e}")
             return pd.DataFrame()
 
-    def get_match_events(self, match_id: int) -> pd.DataFrame:
-        """Get events for a specific match"""
+    def get_match_etags(self) -> Dict[int, str]:
+        """Get the ETag of the events file stored for each processed match"""
+        etags = {}
+        start = 0
         try:
-            events = sb.events(match_id=match_id)
+            while True:
+                result = self.supabase.table('match_etags').select('id, etag').order('id').range(start, start + PAGE_SIZE - 1).execute()
+                etags.update((row['id'], row['etag']) for row in result.data)
+                if len(result.data) < PAGE_SIZE:
+                    return etags
+                start += PAGE_SIZE
+        except Exception as e:
+            logger.warning(f"Could not get match ETags: {e}")
+            return etags
+
+    def get_match_events(self, match_id: int, etag: Optional[str] = None) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+        """Get events and the events file ETag for a specific match; events are None if unchanged since etag"""
+        try:
+            # With API credentials, events come from the StatsBomb API like the lineups do; it does not
+            # serve ETags, so only matches newer than the last update or marked for retry are fetched
+            if api_client.has_auth(DEFAULT_CREDS):
+                events = sb.events(match_id=match_id, flatten_attrs=True)
+                logger.info(f"Retrieved {len(events)} events for match {match_id}")
+                return events, None
+
+            headers = {'If-None-Match': etag} if etag else {}
+            response = requests.get(OPEN_DATA_PATHS['events'].format(match_id=match_id), headers=headers, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 304:
+                logger.info(f"Events for match {match_id} unchanged since last update")
+                return None, etag
+            response.raise_for_status()
+
+            # Same flattened columns as sb.events(flatten_attrs=True)
+            events = pd.DataFrame([flatten_event(event, flatten_attrs=True) for event in response.json()])
             logger.info(f"Retrieved {len(events)} events for match {match_id}")
-            return events
+            return events, response.headers.get('ETag')
         except Exception as e:
             logger.error(f"Error getting events for match {match_id}: {e}")
-            return pd.DataFrame()
+            return pd.DataFrame(), None
 
     def get_match_lineups(self, match_id: int) -> Dict[str, pd.DataFrame]:
         """Get lineups for a specific match"""
@@ -99,81 +186,104 @@ class StatsBombUpdater:
             logger.error(f"Error getting lineups for match {match_id}: {e}")
             return {}
 
-    def upsert_teams(self, teams_data: List[Dict[str, Any]]) -> None:
-        """Upsert teams into Supabase"""
-        try:
-            self.supabase.table('teams').upsert(teams_data, on_conflict='id').execute()
-            logger.info(f"Upserted {len(teams_data)} teams")
-        except Exception as e:
-            logger.error(f"Error upserting teams: {e}")
-
-    def upsert_matches(self, matches_data: List[Dict[str, Any]]) -> None:
-        """Upsert matches into Supabase"""
-        try:
-            self.supabase.table('matches').upsert(matches_data, on_conflict='id').execute()
-            logger.info(f"Upserted {len(matches_data)} matches")
-        except Exception as e:
-            logger.error(f"Error upserting matches: {e}")
-
-    def upsert_competition_standings(self, standings_data: List[Dict[str, Any]]) -> None:
-        """Upsert competition standings into Supabase"""
-        try:
-            self.supabase.table('competition_standings').upsert(standings_data, on_conflict='id').execute()
-            logger.info(f"Upserted {len(standings_data)} competition standings")
-        except Exception as e:
-            logger.error(f"Error upserting competition standings: {e}")
-
-    def upsert_competitions(self, competitions_data: List[Dict[str, Any]]) -> None:
-        """Upsert competitions into Supabase"""
-        try:
-            self.supabase.table('competitions').upsert(competitions_data, on_conflict='id').execute()
-            logger.info(f"Upserted {len(competitions_data)} competitions")
-        except Exception as e:
-            logger.error(f"Error upserting competitions: {e}")
-
-    def upsert_match_player_stats(self, stats_data: List[Dict[str, Any]]) -> None:
-        """Upsert match player stats into Supabase"""
-        try:
-            self.supabase.table('match_player_stats').upsert(stats_data, on_conflict='id').execute()
-            logger.info(f"Upserted {len(stats_data)} match player stats")
-        except Exception as e:
-            logger.error(f"Error upserting match player stats: {e}")
-
-    def upsert_players(self, players_data: List[Dict[str, Any]]) -> None:
-        """Upsert players into Supabase"""
-        try:
-            self.supabase.table('players').upsert(players_data, on_conflict='id').execute()
-            logger.info(f"Upserted {len(players_data)} players")
-        except Exception as e:
-            logger.error(f"Error upserting players: {e}")
-
-    def process_match_data(self, match: pd.Series) -> None:
-        """Process all data for a single match"""
+    def _upsert(self, table: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Upsert rows into a Supabase table in batches of UPSERT_BATCH_SIZE, returning the rows that failed"""
+        failed = []
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            batch = rows[start:start + UPSERT_BATCH_SIZE]
+            try:
+                self.supabase.table(table).upsert(batch, on_conflict='id').execute()
+            except Exception as e:
+                logger.error(f"Error upserting {len(batch)} rows into {table}: {e}")
+                failed.extend(batch)
+        return failed
+
+    def upsert_teams(self, teams_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Upsert teams into Supabase, returning the rows that could not be written"""
+        failed = self._upsert('teams', teams_data)
+        logger.info(f"Upserted {len(teams_data) - len(failed)} of {len(teams_data)} teams")
+        return failed
+
+    def upsert_matches(self, matches_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Upsert matches into Supabase, returning the rows that could not be written"""
+        failed = self._upsert('matches', matches_data)
+        logger.info(f"Upserted {len(matches_data) - len(failed)} of {len(matches_data)} matches")
+        return failed
+
+    def upsert_competition_standings(self, standings_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Upsert competition standings into Supabase, returning the rows that could not be written"""
+        failed = self._upsert('competition_standings', standings_data)
+        logger.info(f"Upserted {len(standings_data) - len(failed)} of {len(standings_data)} competition standings")
+        return failed
+
+    def upsert_competitions(self, competitions_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Upsert competitions into Supabase, returning the rows that could not be written"""
+        failed = self._upsert('competitions', competitions_data)
+        logger.info(f"Upserted {len(competitions_data) - len(failed)} of {len(competitions_data)} competitions")
+        return failed
+
+    def replace_match_player_stats(self, match_ids: List[int], stats_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Replace the match player stats of the given matches, returning the rows that could not be written
+
+        Stats rows have no natural key to upsert on, so a reprocessed match's old rows are deleted first;
+        the new rows of a match are only inserted once its old rows are gone.
+        """
+        cleared = set()
+        for start in range(0, len(match_ids), UPSERT_BATCH_SIZE):
+            batch = match_ids[start:start + UPSERT_BATCH_SIZE]
+            try:
+                self.supabase.table('match_player_stats').delete().in_('match_id', batch).execute()
+                cleared.update(batch)
+            except Exception as e:
+                logger.error(f"Error deleting match player stats of {len(batch)} matches: {e}")
+
+        failed = [stat for stat in stats_data if stat['match_id'] not in cleared]
+        failed.extend(self._upsert('match_player_stats', [stat for stat in stats_data if stat['match_id'] in cleared]))
+        logger.info(f"Replaced {len(stats_data) - len(failed)} of {len(stats_data)} match player stats")
+        return failed
+
+    def upsert_match_etags(self, etags_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Upsert match events ETags into Supabase, returning the rows that could not be written"""
+        failed = self._upsert('match_etags', etags_data)
+        logger.info(f"Upserted {len(etags_data) - len(failed)} of {len(etags_data)} match ETags")
+        return failed
+
+    def delete_match_etags(self, match_ids: List[int]) -> None:
+        """Delete the stored events ETags of the given matches"""
+        for start in range(0, len(match_ids), UPSERT_BATCH_SIZE):
+            batch = match_ids[start:start + UPSERT_BATCH_SIZE]
+            try:
+                self.supabase.table('match_etags').delete().in_('id', batch).execute()
+            except Exception as e:
+                logger.error(f"Error deleting ETags of {len(batch)} matches: {e}")
+
+    def upsert_players(self, players_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Upsert players into Supabase, returning the rows that could not be written"""
+        failed = self._upsert('players', players_data)
+        logger.info(f"Upserted {len(players_data) - len(failed)} of {len(players_data)} players")
+        return failed
+
+    def process_match_data(self, match: pd.Series, etag: Optional[str] = None) -> Optional[MatchRows]:
+        """Build the teams, match, players and match player stats rows for a single match
+
+        Returns None if the match has no events, or if its events file still matches etag.
+        """
         match_id = match['match_id']
 
-        # Get events and lineups
-        events_df = self.get_match_events(match_id)
-        lineups = self.get_match_lineups(match_id)
+        # Events first: an unchanged events file skips the lineups download too
+        events_df, etag = self.get_match_events(match_id, etag)
+        if events_df is None:
+            return None
 
         if events_df.empty:
             logger.warning(f"No events found for match {match_id}")
-            return
+            return None
+
+        lineups = self.get_match_lineups(match_id)
 
         # Extract teams from match
         teams = []
-        # Map competition IDs to countries
-        comp_country_map = {
-            43: 'International',  # WC
-            16: 'Europe',  # CL
-            9: 'Germany',  # BL1
-            11: 'Spain',  # PD
-            7: 'France',  # FL1
-            2: 'England',  # PL
-            12: 'Italy',  # SA
-            68: 'Europe',  # EC
-            35: 'Europe'  # ELC
-        }
-        country = comp_country_map.get(match.get('competition_id'), 'Unknown')
+        country = match.get('country', 'Unknown')
 
         home_team = {
             'id': match['home_team_id'],
@@ -188,15 +298,14 @@ class StatsBombUpdater:
         teams.extend([home_team, away_team])
 
         # Extract players from lineups
-        players = []
-        for team_name, lineup_df in lineups.items():
-            for _, player in lineup_df.iterrows():
-                player_data = {
-                    'id': player['player_id'],
-                    'name': player['player_name'],
-                    'team_id': match['home_team_id'] if team_name == match['home_team'] else match['away_team_id']
-                }
-                players.append(player_data)
+        lineup_frames = [
+            lineup_df[['player_id', 'player_name']]
+            .rename(columns={'player_id': 'id', 'player_name': 'name'})
+            .assign(team_id=match['home_team_id'] if team_name == match['home_team'] else match['away_team_id'])
+            for team_name, lineup_df in lineups.items()
+            if not lineup_df.empty
+        ]
+        players = pd.concat(lineup_frames, ignore_index=True).to_dict('records') if lineup_frames else []
 
         # Prepare match data
         match_data = {
@@ -212,24 +321,66 @@ class StatsBombUpdater:
         }
 
         # Prepare match player stats data
-        match_player_stats = []
-        for _, event in events_df.iterrows():
-            if event.get('player_id') and event.get('type') in ['Pass', 'Shot', 'Dribble', 'Carry']:
-                stat_data = {
-                    'match_id': match_id,
-                    'player_id': event['player_id'],
-                    'minutes': event.get('minute', 0),
-                    'goals': 1 if event.get('shot_outcome') == 'Goal' else 0,
-                    'assists': 1 if event.get('pass_goal_assist') == True else 0,
-                    'rating': event.get('player_rating', 0)
-                }
-                match_player_stats.append(stat_data)
-
-        # Upsert data
-        self.upsert_teams(teams)
-        self.upsert_matches([match_data])
-        self.upsert_players(players)
-        self.upsert_match_player_stats(match_player_stats)
+        sub = events_df.reindex(columns=['type', 'player_id', 'minute', 'shot_outcome', 'pass_goal_assist', 'player_rating'])
+        sub = sub[sub['type'].isin(STAT_EVENT_TYPES) & sub['player_id'].notna()]
+        stats_df = pd.DataFrame({
+            'match_id': match_id,
+            'player_id': sub['player_id'].astype(int),
+            'minutes': sub['minute'].fillna(0).astype('int16'),
+            'goals': (sub['shot_outcome'] == 'Goal').astype('int8'),
+            'assists': sub['pass_goal_assist'].eq(True).astype('int8'),
+            'rating': sub['player_rating'].fillna(0),
+        })
+        match_player_stats = stats_df.to_dict('records')
+
+        return teams, match_data, players, match_player_stats, etag
+
+    def _process_match_safely(self, match: pd.Series, etag: Optional[str] = None) -> Optional[MatchRows]:
+        """Process a match, logging and skipping it on failure so one bad match does not abort the season"""
+        try:
+            return self.process_match_data(match, etag)
+        except Exception as e:
+            logger.error(f"Error processing match {match['match_id']}: {e}")
+            return None
+
+    def store_season(self, results: List[MatchRows]) -> None:
+        """Write a season's match rows at once, then the ETags of the matches that were fully written"""
+        # Teams and players repeat across matches
+        teams, matches_data, players, match_player_stats = {}, [], {}, []
+        for match_teams, match_data, match_players, match_stats, _ in results:
+            teams.update((team['id'], team) for team in match_teams)
+            matches_data.append(match_data)
+            players.update((player['id'], player) for player in match_players)
+            match_player_stats.extend(match_stats)
+
+        failed_teams = {team['id'] for team in self.upsert_teams(list(teams.values()))}
+        failed_matches = {match['id'] for match in self.upsert_matches(matches_data)}
+        failed_players = {player['id'] for player in self.upsert_players(list(players.values()))}
+        failed_matches.update(stat['match_id'] for stat in self.replace_match_player_stats(
+            [int(match_data['id']) for match_data in matches_data], match_player_stats
+        ))
+
+        # A stored ETag lets the next run skip the match, so only record it once every row of the match is in.
+        # Any other match gets RETRY_ETAG: its match row, or a later match's, may already have moved the last
+        # update past its date, and without the marker the date filter would never select it again.
+        match_etags, written_without_etag = [], []
+        for match_teams, match_data, match_players, _, match_etag in results:
+            match_id = int(match_data['id'])
+            written = (
+                match_id not in failed_matches
+                and not any(team['id'] in failed_teams for team in match_teams)
+                and not any(player['id'] in failed_players for player in match_players)
+            )
+            if not written:
+                match_etags.append({'id': match_id, 'etag': RETRY_ETAG})
+            elif match_etag:
+                match_etags.append({'id': match_id, 'etag': match_etag})
+            else:
+                written_without_etag.append(match_id)
+        self.upsert_match_etags(match_etags)
+
+        # Events from the API carry no ETag; clear any retry marker left by an earlier failed write
+        self.delete_match_etags(written_without_etag)
 
     def update_database(self) -> None:
         """Main method to update the database with new StatsBomb data"""
@@ -238,6 +389,12 @@ class StatsBombUpdater:
         last_update = self.get_last_update_date()
         logger.info(f"Last update date: {last_update}")
 
+        # The API serves no ETags, so with credentials a stored ETag cannot tell whether a match changed;
+        # only the retry markers of matches whose rows were not all written still select a match
+        etags = self.get_match_etags()
+        if api_client.has_auth(DEFAULT_CREDS):
+            etags = {match_id: etag for match_id, etag in etags.items() if etag == RETRY_ETAG}
+
         competitions = self.get_competitions()
         if competitions.empty:
             logger.error("No competitions retrieved")
@@ -248,16 +405,29 @@ class StatsBombUpdater:
                 logger.warning(f"Competition {comp_id} not found in available competitions")
                 continue
 
-            recent_seasons = self.get_recent_seasons(comp_id)
+            recent_seasons = self.get_recent_seasons(competitions, comp_id)
             for season_id in recent_seasons:
-                matches = self.get_matches_for_teams(comp_id, season_id, self.key_teams)
-                for _, match in matches.iterrows():
-                    match_date = pd.to_datetime(match['match_date'])
-                    if match_date > last_update:
-                        logger.info(f"Processing match {match['match_id']} from {match_date}")
-                        self.process_match_data(match)
-                    else:
-                        logger.info(f"Skipping match {match['match_id']} (already up to date)")
+                matches = self.get_all_matches(comp_id, season_id)
+                if matches.empty:
+                    continue
+
+                matches['country'] = matches['competition_id'].map(COUNTRY_BY_COMP).fillna('Unknown')
+
+                # Matches with a stored ETag are checked with a conditional request, and matches marked
+                # with RETRY_ETAG are refetched; the date only decides for matches with neither
+                has_etag = matches['match_id'].isin(list(etags))
+                new_matches = matches[has_etag | (pd.to_datetime(matches['match_date']) > last_update)]
+                logger.info(f"Processing {len(new_matches)} matches, skipping {len(matches) - len(new_matches)} already up to date")
+
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    results = list(executor.map(
+                        lambda match: self._process_match_safely(match, etags.get(match['match_id'])),
+                        (match for _, match in new_matches.iterrows())
+                    ))
+
+                results = [result for result in results if result is not None]
+                if results:
+                    self.store_season(results)
 
         logger.info("Database update process completed")
 